@@ -25,9 +25,28 @@ from __future__ import print_function
 import argparse
 import os
 import textwrap
-import xml.etree.cElementTree as et
-
-from mako.template import Template
+from collections import defaultdict
+
+try:
+    from sys import intern
+except ImportError:
+    # Python 2 has intern() as a builtin.
+    pass
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    # Python 2 without the futures backport; just generate serially.
+    ThreadPoolExecutor = None
+
+try:
+    from lxml import etree as et
+    # lxml can filter on the tag in C, so we never see the elements we
+    # don't care about.
+    ITERPARSE_ARGS = {'tag': ('enums', 'feature', 'extension')}
+except ImportError:
+    import xml.etree.cElementTree as et
+    ITERPARSE_ARGS = {}
 
 COPYRIGHT = textwrap.dedent(u"""\
     * Copyright © 2017 Intel Corporation
@@ -50,51 +69,74 @@ COPYRIGHT = textwrap.dedent(u"""\
     * OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
     * SOFTWARE.""")
 
-C_TEMPLATE = Template(textwrap.dedent(u"""\
+PROLOGUE = textwrap.dedent(u"""\
     /* Autogenerated file -- do not edit
-     * generated by ${file}
+     * generated by %(file)s
      *
-     ${copyright}
+     %(copyright)s
      */
 
+    """)
+
+C_INCLUDES = textwrap.dedent(u"""\
     #include <vulkan/vulkan.h>
     #include <vulkan/vk_android_native_buffer.h>
     #include "util/macros.h"
     #include "vk_enum_to_str.h"
+    """)
 
-    % for enum in enums:
+C_LOOKUP_TABLE_HELPERS = textwrap.dedent(u"""\
 
-    const char *
-    vk_${enum.name[2:]}_to_str(${enum.name} input)
+    struct vk_enum_to_str_entry {
+        int value;
+        const char *name;
+    };
+
+    static int
+    vk_enum_to_str_compare(const void *key, const void *elem)
     {
-        switch(input) {
-        % for v in sorted(enum.values.keys()):
-            % if enum.values[v] in FOREIGN_ENUM_VALUES:
-
-            #pragma GCC diagnostic push
-            #pragma GCC diagnostic ignored "-Wswitch"
-            % endif
-            case ${v}:
-                return "${enum.values[v]}";
-            % if enum.values[v] in FOREIGN_ENUM_VALUES:
-            #pragma GCC diagnostic pop
-
-            % endif
-        % endfor
-        default:
-            unreachable("Undefined enum value.");
-        }
+        int value = *(const int *)key;
+        const struct vk_enum_to_str_entry *entry = elem;
+        return (value > entry->value) - (value < entry->value);
     }
-    %endfor"""),
-    output_encoding='utf-8')
+    """)
 
-H_TEMPLATE = Template(textwrap.dedent(u"""\
-    /* Autogenerated file -- do not edit
-     * generated by ${file}
-     *
-     ${copyright}
-     */
+C_FUNCTION_BEGIN = textwrap.dedent(u"""\
+
+    const char *
+    vk_%(short_name)s_to_str(%(name)s input)
+    {
+    """)
+
+C_CASE = (u'        case %d:\n'
+          u'            return "%s";\n')
+
+C_FOREIGN_CASE = (u'\n'
+                  u'        #pragma GCC diagnostic push\n'
+                  u'        #pragma GCC diagnostic ignored "-Wswitch"\n' +
+                  C_CASE +
+                  u'        #pragma GCC diagnostic pop\n'
+                  u'\n')
+
+C_SWITCH_END = (u'    default:\n'
+                u'        %s\n'
+                u'    }\n')
+
+C_TABLE_BEGIN = u'static const struct vk_enum_to_str_entry %s_names[] = {\n'
 
+C_TABLE_ENTRY = u'    { %d, "%s" },\n'
+
+C_TABLE_LOOKUP = (u'    const int key = input;\n'
+                  u'    const struct vk_enum_to_str_entry *entry =\n'
+                  u'        bsearch(&key, %(name)s_names,\n'
+                  u'                ARRAY_SIZE(%(name)s_names), sizeof(*entry),\n'
+                  u'                vk_enum_to_str_compare);\n'
+                  u'    if (entry)\n'
+                  u'        return entry->name;\n')
+
+C_UNREACHABLE = u'unreachable("Undefined enum value.");'
+
+H_BEGIN = textwrap.dedent(u"""\
     #ifndef MESA_VK_ENUM_TO_STR_H
     #define MESA_VK_ENUM_TO_STR_H
 
@@ -105,26 +147,28 @@ H_TEMPLATE = Template(textwrap.dedent(u"""\
     extern "C" {
     #endif
 
-    % for ext in extensions:
-    #define _${ext.name}_number (${ext.number})
-    % endfor
+    """)
 
-    % for enum in enums:
-    const char * vk_${enum.name[2:]}_to_str(${enum.name} input);
-    % endfor
+H_END = textwrap.dedent(u"""\
 
     #ifdef __cplusplus
     } /* extern "C" */
     #endif
 
-    #endif"""),
-    output_encoding='utf-8')
+    #endif""")
 
 # These enums are defined outside their respective enum blocks, and thus cause
 # -Wswitch warnings.
-FOREIGN_ENUM_VALUES = [
+FOREIGN_ENUM_VALUES = frozenset([
     "VK_STRUCTURE_TYPE_NATIVE_BUFFER_ANDROID",
-]
+])
+
+
+# Values added by extensions start here, see add_value().
+EXTENSION_VALUE_BASE = 1000000000
+
+# Buffer size for the generated files, big enough to hold all of either.
+OUTPUT_BUFFER_SIZE = 1 << 20
 
 
 class NamedFactory(object):
@@ -135,9 +179,10 @@ class NamedFactory(object):
         self.type = type_
 
     def __call__(self, name, **kwargs):
-        try:
-            return self.registry[name]
-        except KeyError:
+        # Most calls during parsing create a new entry, so avoid paying for
+        # a KeyError each time.
+        n = self.registry.get(name)
+        if n is None:
             n = self.registry[name] = self.type(name, **kwargs)
         return n
 
@@ -158,71 +203,211 @@ class VkEnum(object):
 
     def __init__(self, name, values=None):
         self.name = name
-        # Maps numbers to names
+        # Maps numbers to (name, len(name))
         self.values = values or dict()
-        self.name_to_value = dict()
 
     def add_value(self, name, value=None,
                   extnum=None, offset=None,
                   error=False):
+        """Add a value, returning its number."""
         assert value is not None or extnum is not None
         if value is None:
-            value = 1000000000 + (extnum - 1) * 1000 + offset
+            value = EXTENSION_VALUE_BASE + (extnum - 1) * 1000 + offset
             if error:
                 value = -value
 
-        self.name_to_value[name] = value
-        if value not in self.values:
-            self.values[value] = name
-        elif len(self.values[value]) > len(name):
-            self.values[value] = name
-
-    def add_value_from_xml(self, elem, extension=None):
-        if 'value' in elem.attrib:
-            self.add_value(elem.attrib['name'],
-                           value=int(elem.attrib['value'], base=0))
-        elif 'alias' in elem.attrib:
-            self.add_value(elem.attrib['name'],
-                           value=self.name_to_value[elem.attrib['alias']])
+        # Names end up as dict keys and are compared a lot while parsing,
+        # interning them makes those comparisons an identity check.
+        name = intern(name)
+
+        # Keep the shortest name for each value; remembering its length
+        # saves recomputing it for every alias we see.
+        cur = self.values.get(value)
+        name_len = len(name)
+        if cur is None or cur[1] > name_len:
+            self.values[value] = (name, name_len)
+        return value
+
+    def add_value_from_xml(self, elem, name_to_value, extension=None):
+        """Add the value described by elem, returning its number.
+
+        name_to_value maps the names seen so far in this enum to their
+        numbers, and is used to resolve aliases.
+        """
+        get = elem.get
+        name = get('name')
+        value = get('value')
+        if value is not None:
+            return self.add_value(name, value=int(value, base=0))
+
+        alias = get('alias')
+        if alias is not None:
+            return self.add_value(name, value=name_to_value[alias])
+
+        extnum = get('extnumber')
+        if extnum is not None:
+            extnum = int(extnum)
         else:
-            error = 'dir' in elem.attrib and elem.attrib['dir'] == '-'
-            if 'extnumber' in elem.attrib:
-                extnum = int(elem.attrib['extnumber'])
-            else:
-                extnum = extension.number
-            self.add_value(elem.attrib['name'],
-                           extnum=extnum,
-                           offset=int(elem.attrib['offset']),
-                           error=error)
+            extnum = extension.number
+        return self.add_value(name,
+                              extnum=extnum,
+                              offset=int(get('offset')),
+                              error=get('dir') == '-')
 
 
-def parse_xml(enum_factory, ext_factory, filename):
+def _extends_values(elem):
+    """Yield the <enum extends="..."> elements of a feature or extension."""
+    for require in elem:
+        if require.tag != 'require':
+            continue
+        for value in require:
+            if value.tag == 'enum' and value.get('extends') is not None:
+                yield value
+
+
+def parse_xml(enum_factory, ext_factory, name_to_value, filename):
     """Parse the XML file. Accumulate results into the factories.
 
     This parser is a memory efficient iterative XML parser that returns a list
-    of VkEnum objects.
+    of VkEnum objects. name_to_value maps enum names to a {value name: number}
+    dict, and is shared between files so aliases can refer to values from an
+    earlier one.
     """
 
-    xml = et.parse(filename)
+    # Values added to existing enums by features and extensions, grouped by
+    # the enum they extend. The elements are cleared as we go, so keep a
+    # copy of their attributes.
+    by_extends = defaultdict(list)
+
+    # Aliases whose target hasn't been seen yet, resolved once the whole
+    # file has been walked.
+    deferred = []
+
+    def add_value(enum, value, extension=None):
+        names = name_to_value[enum.name]
+        name = value.get('name')
+        alias = value.get('alias')
+        if alias is not None and alias not in names:
+            deferred.append((enum, name, alias))
+        else:
+            names[name] = enum.add_value_from_xml(value, names, extension)
+
+    for _, elem in et.iterparse(filename, events=('end',), **ITERPARSE_ARGS):
+        if elem.tag == 'enums':
+            if elem.get('type') == 'enum':
+                enum = enum_factory(intern(elem.get('name')))
+                for value in elem:
+                    if value.tag == 'enum':
+                        add_value(enum, value)
+        elif elem.tag == 'feature':
+            for value in _extends_values(elem):
+                by_extends[intern(value.get('extends'))].append(
+                    (dict(value.attrib), None))
+        elif elem.tag == 'extension':
+            if elem.get('supported') == 'vulkan':
+                extension = ext_factory(elem.get('name'),
+                                        number=int(elem.get('number')))
+
+                for value in _extends_values(elem):
+                    by_extends[intern(value.get('extends'))].append(
+                        (dict(value.attrib), extension))
+        else:
+            continue
 
-    for enum_type in xml.findall('./enums[@type="enum"]'):
-        enum = enum_factory(enum_type.attrib['name'])
-        for value in enum_type.findall('./enum'):
-            enum.add_value_from_xml(value)
+        # Everything we need from this subtree has been consumed; drop it
+        # (and, with lxml, any earlier siblings) to keep memory bounded.
+        elem.clear()
+        if hasattr(elem, 'getprevious'):
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
 
-    for value in xml.findall('./feature/require/enum[@extends]'):
-        enum = enum_factory.get(value.attrib['extends'])
+    for name, values in by_extends.items():
+        enum = enum_factory.get(name)
         if enum is not None:
-            enum.add_value_from_xml(value)
-
-    for ext_elem in xml.findall('./extensions/extension[@supported="vulkan"]'):
-        extension = ext_factory(ext_elem.attrib['name'],
-                                number=int(ext_elem.attrib['number']))
-
-        for value in ext_elem.findall('./require/enum[@extends]'):
-            enum = enum_factory.get(value.attrib['extends'])
-            if enum is not None:
-                enum.add_value_from_xml(value, extension)
+            for attrs, extension in values:
+                add_value(enum, attrs, extension)
+
+    # An alias may point at another deferred alias, so keep going until
+    # nothing is left, or a whole pass makes no progress.
+    while deferred:
+        pending = []
+        for enum, name, alias in deferred:
+            names = name_to_value[enum.name]
+            if alias in names:
+                names[name] = enum.add_value(name, value=names[alias])
+            else:
+                pending.append((enum, name, alias))
+        if len(pending) == len(deferred):
+            enum, name, alias = pending[0]
+            raise ValueError('%s: %s is an alias of unknown value %s'
+                             % (enum.name, name, alias))
+        deferred = pending
+
+
+def _prologue():
+    return PROLOGUE % {'file': os.path.basename(__file__),
+                       'copyright': COPYRIGHT}
+
+
+def _c_function(enum, lookup_table):
+    """Return the C source of vk_*_to_str() for a single enum."""
+    parts = []
+    if lookup_table and enum.sorted_items:
+        parts.append(u'\n' + C_TABLE_BEGIN % enum.name)
+        parts.extend([C_TABLE_ENTRY % (v, name)
+                      for v, name, _ in enum.sorted_items])
+        parts.append(u'};\n')
+
+    parts.append(C_FUNCTION_BEGIN % {'short_name': enum.name[2:],
+                                     'name': enum.name})
+    if lookup_table:
+        if enum.sorted_items:
+            parts.append(C_TABLE_LOOKUP % {'name': enum.name})
+        parts.append(u'    ' + C_UNREACHABLE + u'\n')
+    else:
+        last = len(enum.case_groups) - 1
+        for i, items in enumerate(enum.case_groups):
+            parts.append(u'    switch(input) {\n')
+            parts.extend([(C_FOREIGN_CASE if foreign else C_CASE) % (v, name)
+                          for v, name, foreign in items])
+            parts.append(C_SWITCH_END %
+                         (C_UNREACHABLE if i == last else u'break;'))
+    parts.append(u'}\n')
+    return u''.join(parts)
+
+
+def emit_c(enums, out, lookup_table=False):
+    """Write vk_enum_to_str.c to the binary file out."""
+    head = [_prologue()]
+    if lookup_table:
+        head.append(u'#include <stdlib.h>\n')
+    head.append(C_INCLUDES)
+    if lookup_table:
+        head.append(C_LOOKUP_TABLE_HELPERS)
+    head.append(u'\n')
+    out.write(u''.join(head).encode('utf-8'))
+
+    for enum in enums:
+        out.write(_c_function(enum, lookup_table).encode('utf-8'))
+
+
+def emit_h(enums, extensions, out):
+    """Write vk_enum_to_str.h to the binary file out."""
+    parts = [_prologue(), H_BEGIN]
+    parts.extend([u'#define _%s_number (%d)\n' % (ext.name, ext.number)
+                  for ext in extensions])
+    parts.append(u'\n')
+    parts.extend([u'const char * vk_%s_to_str(%s input);\n' %
+                  (enum.name[2:], enum.name) for enum in enums])
+    parts.append(H_END)
+    out.write(u''.join(parts).encode('utf-8'))
+
+
+def _write_file(path, emit, args, kwargs):
+    # The emitters write one small chunk per enum; use a large buffer so
+    # those coalesce into a handful of write() calls.
+    with open(path, 'wb', OUTPUT_BUFFER_SIZE) as f:
+        emit(*args, out=f, **kwargs)
 
 
 def main():
@@ -234,25 +419,55 @@ def main():
     parser.add_argument('--outdir',
                         help='Directory to put the generated files in',
                         required=True)
+    parser.add_argument('--lookup-table',
+                        help='Use sorted tables searched with bsearch() '
+                             'instead of switch statements',
+                        action='store_true')
 
     args = parser.parse_args()
 
     enum_factory = NamedFactory(VkEnum)
     ext_factory = NamedFactory(VkExtension)
+    # Only needed to resolve aliases while parsing, so it lives here rather
+    # than in VkEnum.
+    name_to_value = defaultdict(dict)
     for filename in args.xml_files:
-        parse_xml(enum_factory, ext_factory, filename)
+        parse_xml(enum_factory, ext_factory, name_to_value, filename)
     enums = sorted(enum_factory.registry.values(), key=lambda e: e.name)
     extensions = sorted(ext_factory.registry.values(), key=lambda e: e.name)
 
-    for template, file_ in [(C_TEMPLATE, os.path.join(args.outdir, 'vk_enum_to_str.c')),
-                            (H_TEMPLATE, os.path.join(args.outdir, 'vk_enum_to_str.h'))]:
-        with open(file_, 'wb') as f:
-            f.write(template.render(
-                file=os.path.basename(__file__),
-                enums=enums,
-                extensions=extensions,
-                copyright=COPYRIGHT,
-                FOREIGN_ENUM_VALUES=FOREIGN_ENUM_VALUES))
+    # Resolve the sort order and foreign-ness of every value once here, so
+    # emit_c() doesn't have to do it per case.
+    for enum in enums:
+        enum.sorted_items = [(v, name, name in FOREIGN_ENUM_VALUES)
+                             for v, (name, _) in sorted(enum.values.items())]
+
+        # Core values are small and dense, extension values are spread out
+        # above EXTENSION_VALUE_BASE. Give each set its own switch so the
+        # compiler can still emit a jump table for the core range.
+        dense = [i for i in enum.sorted_items
+                 if abs(i[0]) < EXTENSION_VALUE_BASE]
+        sparse = [i for i in enum.sorted_items
+                  if abs(i[0]) >= EXTENSION_VALUE_BASE]
+        enum.case_groups = [g for g in (dense, sparse) if g] or [[]]
+
+    jobs = [
+        (os.path.join(args.outdir, 'vk_enum_to_str.c'), emit_c,
+         (enums,), {'lookup_table': args.lookup_table}),
+        (os.path.join(args.outdir, 'vk_enum_to_str.h'), emit_h,
+         (enums, extensions), {}),
+    ]
+
+    # Nothing is modified once parsing is done, so both files can be
+    # generated at the same time.
+    if ThreadPoolExecutor is not None:
+        with ThreadPoolExecutor(max_workers=len(jobs)) as executor:
+            futures = [executor.submit(_write_file, *job) for job in jobs]
+            for future in futures:
+                future.result()
+    else:
+        for job in jobs:
+            _write_file(*job)
 
 
 if __name__ == '__main__':